@@ -0,0 +1,2 @@
+# test_supabase.py es un script manual que se conecta a Supabase al importarse
+collect_ignore = ["test_supabase.py"]
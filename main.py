@@ -1,9 +1,18 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, status
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, BackgroundTasks, Header, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from typing import Optional
-import uuid
-from pydantic import BaseModel
+import re
+import asyncio
+import base64
+import hashlib
+import time
+from functools import lru_cache
+from typing import Any, Optional
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from anyio import to_thread
+import orjson
+from cachetools import TTLCache
 import logging
 from datetime import datetime
 
@@ -14,18 +23,66 @@ logger = logging.getLogger(__name__)
 # Intentar importar Supabase
 try:
     from supabase import create_client, Client
+    from postgrest.exceptions import APIError
+    import httpx
     SUPABASE_AVAILABLE = True
     logger.info("✅ Supabase importado correctamente")
 except ImportError as e:
     SUPABASE_AVAILABLE = False
+    Client = Any  # Marcador para las anotaciones de tipo
+
+    class APIError(Exception):
+        pass
+
     logger.warning(f"⚠️  Supabase no disponible: {e}")
 
+from models import User, UserPage
+from storage import BUCKET_NAME, MAX_FOTO_BYTES, subir_imagen_supabase, eliminar_imagen_supabase
+
+# Intentar importar asyncpg (acceso directo a Postgres)
+try:
+    import asyncpg
+    ASYNCPG_AVAILABLE = True
+except ImportError:
+    ASYNCPG_AVAILABLE = False
+
 app = FastAPI(
     title="API Gestión de Usuarios",
     description="API para CRUD de usuarios con Supabase Storage",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# Límite del cuerpo de POST/PUT: la imagen más margen para los demás campos y
+# los delimitadores del multipart
+MAX_CUERPO_BYTES = MAX_FOTO_BYTES + 64 * 1024
+
+class LimiteTamanoSubidas:
+    """Middleware ASGI que rechaza subidas demasiado grandes antes de leer el cuerpo.
+
+    Solo inspecciona las cabeceras de POST/PUT; el resto de peticiones pasa
+    directamente a la aplicación.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT"):
+            for nombre, valor in scope["headers"]:
+                if nombre == b"content-length":
+                    if valor.isdigit() and int(valor) > MAX_CUERPO_BYTES:
+                        response = ORJSONResponse(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            content={"detail": "La imagen supera el tamaño máximo permitido"}
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(LimiteTamanoSubidas)
+
 # Configurar CORS
 app.add_middleware(
     CORSMiddleware,
@@ -36,10 +93,77 @@ app.add_middleware(
 )
 
 # Configurar Supabase
-supabase = None
-BUCKET_NAME = "StudentMgmt_FastApi"
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# Pool HTTP hacia PostgREST y Storage
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE = 10
+HTTP_RETRIES = 2
+_sesiones_http = []
+
+def _crear_sesion_pooled(session):
+    """Crea un cliente con pool de conexiones a partir de una sesión existente.
+
+    Se instancia la misma clase que la sesión original (SyncClient de
+    postgrest/storage3, subclases de httpx.Client) para conservar su aclose().
+    """
+    transport = httpx.HTTPTransport(
+        retries=HTTP_RETRIES,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE
+        )
+    )
+    return type(session)(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        transport=transport
+    )
+
+def _configurar_pool_http(client: Client):
+    """Reemplaza las sesiones por defecto de PostgREST y Storage por sesiones con pool"""
+    postgrest = client.postgrest
+    pooled = _crear_sesion_pooled(postgrest.session)
+    postgrest.session.close()
+    postgrest.session = pooled
+    _sesiones_http.append(pooled)
+
+    storage = client.storage
+    pooled = _crear_sesion_pooled(storage._client)
+    storage._client.close()
+    storage._client = pooled
+    if hasattr(storage, "session"):
+        storage.session = pooled
+    _sesiones_http.append(pooled)
+
+# Hilos disponibles para las llamadas bloqueantes de supabase-py
+THREADPOOL_SIZE = 64
+
+@app.on_event("startup")
+async def ampliar_threadpool():
+    """Amplía el threadpool de anyio que usan _db y las tareas en segundo plano"""
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+async def _db(fn, *args, **kwargs):
+    """Ejecuta una llamada bloqueante de supabase-py en el threadpool.
+
+    supabase-py es síncrono: llamarlo directamente bloquearía el event loop
+    y serializaría todas las peticiones del worker.
+    """
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Optional[Client]:
+    """Devuelve el cliente de Supabase compartido por toda la aplicación.
+
+    El cliente se crea una sola vez y se reutiliza en cada petición, de modo
+    que todas las rutas comparten la misma conexión HTTP hacia Supabase.
+    """
+    if not SUPABASE_AVAILABLE:
+        logger.warning("⚠️  Supabase no disponible - Modo sin base de datos")
+        return None
 
-if SUPABASE_AVAILABLE:
     supabase_url = os.getenv("SUPABASE_URL")
     supabase_key = os.getenv("SUPABASE_KEY")
 
@@ -50,96 +174,246 @@ if SUPABASE_AVAILABLE:
     else:
         logger.info("SUPABASE_KEY configurado: No")
 
-    if supabase_url and supabase_key:
-        try:
-            supabase = create_client(supabase_url, supabase_key)
-            logger.info("✅ Conectado a Supabase correctamente")
-            
-            # Test de conexión
-            try:
-                response = supabase.table("usuarios").select("count", count="exact").limit(1).execute()
-                logger.info("✅ Conexión a la base de datos verificada")
-            except Exception as e:
-                logger.warning(f"⚠️  Tabla 'usuarios' podría no existir: {e}")
-                
-        except Exception as e:
-            logger.error(f"❌ Error conectando a Supabase: {e}")
-            supabase = None
-    else:
+    if not (supabase_url and supabase_key):
         logger.warning("⚠️  Variables de entorno de Supabase no configuradas")
         logger.info("💡 Configure SUPABASE_URL y SUPABASE_KEY en Render")
-else:
-    logger.warning("⚠️  Supabase no disponible - Modo sin base de datos")
-
-# Modelos Pydantic
-class UserBase(BaseModel):
-    nombre: str
-    email: str
-    telefono: str
-
-class User(UserBase):
-    id: int
-    foto_url: Optional[str] = None
-    creado_en: Optional[str] = None
-
-    class Config:
-        from_attributes = True
-
-class SuccessResponse(BaseModel):
-    message: str
-    success: bool = True
-
-class HealthResponse(BaseModel):
-    status: str
-    database: str
-    timestamp: str
-    environment: str
-
-async def subir_imagen_supabase(file: UploadFile) -> str:
-    """Sube una imagen al bucket de Supabase Storage"""
-    if not supabase:
-        raise HTTPException(status_code=500, detail="Servicio de almacenamiento no disponible")
-    
+        return None
+
     try:
-        if not file.content_type.startswith('image/'):
-            raise ValueError("El archivo debe ser una imagen")
-        
-        # Generar nombre único
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-        filename = f"usuarios/{uuid.uuid4().hex[:8]}.{file_extension}"
-        
-        # Leer contenido
-        file_content = await file.read()
-        
-        # Subir a Supabase Storage
-        response = supabase.storage.from_(BUCKET_NAME).upload(
-            file=file_content,
-            path=filename,
-            file_options={"content-type": file.content_type}
-        )
-        
-        # Obtener URL pública
-        public_url = supabase.storage.from_(BUCKET_NAME).get_public_url(filename)
-        logger.info(f"✅ Imagen subida: {filename}")
-        
-        return public_url
-        
+        client = create_client(supabase_url, supabase_key)
+        logger.info("✅ Conectado a Supabase correctamente")
+    except Exception as e:
+        logger.error(f"❌ Error conectando a Supabase: {e}")
+        return None
+
+    try:
+        _configurar_pool_http(client)
+        logger.info("✅ Pool de conexiones HTTP configurado")
     except Exception as e:
-        logger.error(f"❌ Error subiendo imagen: {e}")
-        raise HTTPException(status_code=400, detail=f"Error al subir imagen: {str(e)}")
+        logger.warning(f"⚠️  No se pudo configurar el pool HTTP, usando sesiones por defecto: {e}")
+
+    # Test de conexión
+    try:
+        client.table("usuarios").select("count", count="exact").limit(1).execute()
+        logger.info("✅ Conexión a la base de datos verificada")
+    except Exception as e:
+        logger.warning(f"⚠️  Tabla 'usuarios' podría no existir: {e}")
+
+    return client
 
-async def eliminar_imagen_supabase(image_url: str):
-    """Elimina una imagen del Supabase Storage"""
-    if not supabase or not image_url:
+supabase = get_supabase()
+
+async def supabase_client() -> Optional[Client]:
+    """Dependencia que devuelve el cliente cacheado por get_supabase().
+
+    Es async para que FastAPI la resuelva en el event loop y no en el threadpool.
+    """
+    return get_supabase()
+
+@app.on_event("shutdown")
+def cerrar_sesiones_http():
+    """Cierra las sesiones HTTP con pool al apagar la aplicación"""
+    for session in _sesiones_http:
+        session.close()
+    _sesiones_http.clear()
+
+# Configurar pool directo a Postgres (opcional)
+# Si SUPABASE_DB_URL está definido, las rutas CRUD usan asyncpg en lugar de PostgREST.
+db_pool = None
+USUARIO_COLUMNAS = "id,nombre,email,telefono,foto_url,creado_en"
+
+@app.on_event("startup")
+async def iniciar_pool_db():
+    """Crea el pool de conexiones a Postgres si está configurado"""
+    global db_pool
+    db_url = os.getenv("SUPABASE_DB_URL")
+
+    if not db_url:
+        logger.info("💡 SUPABASE_DB_URL no configurado - usando PostgREST para el CRUD")
         return
-        
+    if not ASYNCPG_AVAILABLE:
+        logger.warning("⚠️  asyncpg no disponible - usando PostgREST para el CRUD")
+        return
+
     try:
-        if BUCKET_NAME in image_url:
-            filename = image_url.split(f"/{BUCKET_NAME}/")[-1]
-            supabase.storage.from_(BUCKET_NAME).remove([filename])
-            logger.info(f"✅ Imagen eliminada: {filename}")
+        # statement_cache_size=0 para ser compatible con el pooler de Supabase (Supavisor)
+        db_pool = await asyncpg.create_pool(
+            dsn=db_url,
+            min_size=2,
+            max_size=10,
+            statement_cache_size=0
+        )
+        logger.info("✅ Pool de Postgres creado correctamente")
     except Exception as e:
-        logger.warning(f"⚠️  Error eliminando imagen: {e}")
+        logger.error(f"❌ Error creando el pool de Postgres: {e}")
+        db_pool = None
+
+@app.on_event("shutdown")
+async def cerrar_pool_db():
+    """Cierra el pool de conexiones a Postgres"""
+    if db_pool:
+        await db_pool.close()
+
+async def get_db_pool():
+    """Devuelve el pool de Postgres, o None si no está configurado.
+
+    Es async para que FastAPI la resuelva en el event loop y no en el threadpool.
+    """
+    return db_pool
+
+def _fila_a_usuario(row) -> dict:
+    """Convierte una fila de asyncpg al formato que devuelve PostgREST"""
+    usuario = dict(row)
+    if usuario.get("creado_en") is not None:
+        usuario["creado_en"] = usuario["creado_en"].isoformat()
+    return usuario
+
+async def _pg_listar_usuarios(pool, limit: int, cursor: Optional[tuple]) -> tuple[list[dict], Optional[int]]:
+    """Devuelve una página de usuarios y, en la primera página, el total"""
+    async with pool.acquire() as conn:
+        if cursor:
+            creado_en, ultimo_id = cursor
+            rows = await conn.fetch(
+                f"SELECT {USUARIO_COLUMNAS} FROM usuarios "
+                "WHERE (creado_en, id) < ($1, $2) "
+                "ORDER BY creado_en DESC, id DESC LIMIT $3",
+                datetime.fromisoformat(creado_en), ultimo_id, limit
+            )
+            return [_fila_a_usuario(r) for r in rows], None
+
+        # count(*) OVER () se evalúa antes del LIMIT: el total llega en la misma consulta
+        rows = await conn.fetch(
+            f"SELECT {USUARIO_COLUMNAS}, count(*) OVER () AS total FROM usuarios "
+            "ORDER BY creado_en DESC, id DESC LIMIT $1",
+            limit
+        )
+    usuarios = [_fila_a_usuario(r) for r in rows]
+    total = usuarios[0].pop("total") if usuarios else 0
+    for usuario in usuarios[1:]:
+        del usuario["total"]
+    return usuarios, total
+
+async def _pg_obtener_usuario(pool, usuario_id: int) -> Optional[dict]:
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT {USUARIO_COLUMNAS} FROM usuarios WHERE id = $1", usuario_id
+        )
+    return _fila_a_usuario(row) if row else None
+
+async def _pg_crear_usuario(pool, data: dict) -> dict:
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "INSERT INTO usuarios (nombre, email, telefono, foto_url) "
+            f"VALUES ($1, $2, $3, $4) RETURNING {USUARIO_COLUMNAS}",
+            data["nombre"], data["email"], data["telefono"], data["foto_url"]
+        )
+    return _fila_a_usuario(row)
+
+async def _pg_actualizar_usuario(pool, usuario_id: int, data: dict) -> Optional[dict]:
+    """Actualiza el usuario y devuelve la fila nueva junto con su foto anterior"""
+    # Las columnas provienen de claves internas, nunca de la entrada del usuario
+    columnas = list(data)
+    asignaciones = ", ".join(f"{col} = ${i}" for i, col in enumerate(columnas, start=2))
+    retorno = ", ".join(f"u.{col}" for col in USUARIO_COLUMNAS.split(","))
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            f"UPDATE usuarios u SET {asignaciones} "
+            "FROM (SELECT foto_url FROM usuarios WHERE id = $1 FOR UPDATE) anterior "
+            f"WHERE u.id = $1 RETURNING {retorno}, anterior.foto_url AS foto_url_anterior",
+            usuario_id, *(data[col] for col in columnas)
+        )
+    return _fila_a_usuario(row) if row else None
+
+async def _pg_eliminar_usuario(pool, usuario_id: int) -> Optional[dict]:
+    """Elimina el usuario y devuelve su foto_url, o None si no existe"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "DELETE FROM usuarios WHERE id = $1 RETURNING foto_url", usuario_id
+        )
+    return dict(row) if row else None
+
+def _normalizar(valor: str) -> str:
+    return valor.strip()
+
+def _normalizar_email(email: str) -> str:
+    """Normaliza y valida un correo electrónico"""
+    email = email.strip().lower()
+    if not EMAIL_RE.match(email):
+        # Mismo formato que los errores de validación de FastAPI
+        raise HTTPException(status_code=422, detail=[{
+            "loc": ["body", "email"],
+            "msg": "Correo electrónico no válido",
+            "type": "value_error"
+        }])
+    return email
+
+# Caché en memoria de las lecturas (por proceso); se vacía en cada escritura
+_CACHE = TTLCache(maxsize=1024, ttl=5)
+
+def _calcular_etag(payload) -> str:
+    contenido = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    return f'"{hashlib.blake2b(contenido, digest_size=8).hexdigest()}"'
+
+def _codificar_cursor(usuario: dict) -> str:
+    """Codifica la posición (creado_en, id) de un usuario como cursor opaco"""
+    return base64.urlsafe_b64encode(f"{usuario['creado_en']}|{usuario['id']}".encode()).decode()
+
+def _decodificar_cursor(cursor: str) -> tuple:
+    try:
+        creado_en, _, usuario_id = base64.urlsafe_b64decode(cursor.encode()).decode().rpartition("|")
+        datetime.fromisoformat(creado_en)
+        return creado_en, int(usuario_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+# ==============================
+# RESPUESTAS ESTÁTICAS
+# ==============================
+
+ENVIRONMENT = "production" if os.getenv("RENDER") else "development"
+
+# El cliente de Supabase es único por proceso, así que la respuesta raíz no
+# cambia: se serializa una sola vez al arrancar
+_ROOT_JSON = orjson.dumps({
+    "message": "API de Gestión de Usuarios",
+    "version": "1.0.0",
+    "environment": ENVIRONMENT,
+    "database": "conectado" if supabase else "no conectado",
+    "endpoints": {
+        "crear_usuario": "POST /api/usuarios",
+        "listar_usuarios": "GET /api/usuarios",
+        "editar_usuario": "PUT /api/usuarios/{id}",
+        "eliminar_usuario": "DELETE /api/usuarios/{id}",
+        "health": "GET /health",
+        "storage_status": "GET /storage/status",
+        "docs": "GET /docs"
+    },
+    "storage_bucket": BUCKET_NAME
+})
+
+# El health check se consulta con mucha frecuencia: el estado de la base de
+# datos se reutiliza durante 5 s y la marca de tiempo tiene resolución de 1 s
+_HEALTH_CACHE = TTLCache(maxsize=1, ttl=5)
+_TS_CACHE = [0, ""]
+
+def _now_iso() -> str:
+    t = int(time.time())
+    if t != _TS_CACHE[0]:
+        _TS_CACHE[0] = t
+        _TS_CACHE[1] = datetime.fromtimestamp(t).isoformat()
+    return _TS_CACHE[1]
+
+_STORAGE_NO_CONFIGURADO = {
+    "status": "error",
+    "message": "Supabase no configurado",
+    "bucket": BUCKET_NAME
+}
+
+_STORAGE_CONECTADO = {
+    "status": "connected",
+    "bucket": BUCKET_NAME,
+    "message": "Conexión a Supabase Storage exitosa"
+}
 
 # ==============================
 # ENDPOINTS
@@ -148,69 +422,43 @@ async def eliminar_imagen_supabase(image_url: str):
 @app.get("/")
 async def root():
     """Endpoint raíz - Información de la API"""
-    db_status = "conectado" if supabase else "no conectado"
-    environment = "production" if os.getenv("RENDER") else "development"
-    
-    return {
-        "message": "API de Gestión de Usuarios",
-        "version": "1.0.0",
-        "environment": environment,
-        "database": db_status,
-        "endpoints": {
-            "crear_usuario": "POST /api/usuarios",
-            "listar_usuarios": "GET /api/usuarios", 
-            "editar_usuario": "PUT /api/usuarios/{id}",
-            "eliminar_usuario": "DELETE /api/usuarios/{id}",
-            "health": "GET /health",
-            "storage_status": "GET /storage/status",
-            "docs": "GET /docs"
-        },
-        "storage_bucket": BUCKET_NAME
-    }
+    return Response(content=_ROOT_JSON, media_type="application/json")
 
 @app.get("/health")
-async def health_check():
+async def health_check(client: Optional[Client] = Depends(supabase_client)):
     """Health check para monitorización"""
-    db_status = "unhealthy"
-    environment = "production" if os.getenv("RENDER") else "development"
+    db_status = _HEALTH_CACHE.get("database")
     
-    # Verificar conexión a Supabase
-    if supabase:
-        try:
-            # Test simple de conexión
-            supabase.table("usuarios").select("count", count="exact").limit(1).execute()
-            db_status = "healthy"
-        except Exception as e:
-            db_status = f"unhealthy: {str(e)}"
-    else:
-        db_status = "not_configured"
+    # Verificar conexión a Supabase (como mucho una vez cada 5 s)
+    if db_status is None:
+        if client:
+            try:
+                # Test simple de conexión
+                await _db(client.table("usuarios").select("count", count="exact").limit(1).execute)
+                db_status = "healthy"
+            except Exception as e:
+                db_status = f"unhealthy: {str(e)}"
+        else:
+            db_status = "not_configured"
+        _HEALTH_CACHE["database"] = db_status
     
     return {
         "status": "healthy",
         "database": db_status,
-        "timestamp": datetime.now().isoformat(),
-        "environment": environment,
+        "timestamp": _now_iso(),
+        "environment": ENVIRONMENT,
         "service": "StudentMgmt API"
     }
 
 @app.get("/storage/status")
-async def storage_status():
+async def storage_status(client: Optional[Client] = Depends(supabase_client)):
     """Verificar estado del storage"""
-    if not supabase:
-        return {
-            "status": "error",
-            "message": "Supabase no configurado",
-            "bucket": BUCKET_NAME
-        }
+    if not client:
+        return _STORAGE_NO_CONFIGURADO
     
     try:
-        response = supabase.storage.from_(BUCKET_NAME).list()
-        return {
-            "status": "connected",
-            "bucket": BUCKET_NAME,
-            "files_count": len(response) if response else 0,
-            "message": "Conexión a Supabase Storage exitosa"
-        }
+        response = await _db(client.storage.from_(BUCKET_NAME).list)
+        return {**_STORAGE_CONECTADO, "files_count": len(response) if response else 0}
     except Exception as e:
         return {
             "status": "error", 
@@ -218,42 +466,104 @@ async def storage_status():
             "message": f"Error conectando al bucket: {str(e)}"
         }
 
-@app.get("/api/usuarios", response_model=list[User])
-async def listar_usuarios():
-    """Listar todos los usuarios registrados"""
-    if not supabase:
+@app.get("/api/usuarios", response_model=UserPage)
+async def listar_usuarios(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    client: Optional[Client] = Depends(supabase_client),
+    pool=Depends(get_db_pool)
+):
+    """Listar los usuarios registrados, paginados por (creado_en, id)"""
+    if not pool and not client:
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     
+    posicion = _decodificar_cursor(cursor) if cursor else None
+    clave = ("list", limit, cursor)
+    
     try:
-        response = supabase.table("usuarios").select("*").order("creado_en", desc=True).execute()
+        cached = _CACHE.get(clave)
+        if cached is None:
+            if pool:
+                usuarios, total = await _pg_listar_usuarios(pool, limit, posicion)
+            else:
+                query = (
+                    client.table("usuarios")
+                    # En la primera página PostgREST devuelve el total en la misma llamada
+                    .select(USUARIO_COLUMNAS, count=None if posicion else "exact")
+                    .limit(limit)
+                )
+                # postgrest 0.10 repite el parámetro order en cada llamada a order():
+                # ambas columnas del orden se envían en un único parámetro
+                query.params = query.params.set("order", "creado_en.desc,id.desc")
+                if posicion:
+                    creado_en, ultimo_id = posicion
+                    # postgrest 0.10 no tiene or_(): el filtro se añade como parámetro
+                    query.params = query.params.add(
+                        "or",
+                        f'(creado_en.lt."{creado_en}",'
+                        f'and(creado_en.eq."{creado_en}",id.lt.{ultimo_id}))'
+                    )
+                result = await _db(query.execute)
+                usuarios, total = result.data, result.count
+                
+            logger.info(f"✅ Usuarios listados: {len(usuarios)} encontrados")
+            payload = {
+                "data": usuarios,
+                "total": total,
+                "next_cursor": _codificar_cursor(usuarios[-1]) if len(usuarios) == limit else None
+            }
+            cached = _CACHE[clave] = (payload, _calcular_etag(payload))
         
-        if hasattr(response, 'error') and response.error:
-            logger.error(f"❌ Error listando usuarios: {response.error.message}")
-            raise HTTPException(status_code=500, detail=response.error.message)
-            
-        logger.info(f"✅ Usuarios listados: {len(response.data)} encontrados")
-        return response.data
+        payload, etag = cached
+        if if_none_match == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "public, max-age=5"
+        return payload
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error listando usuarios: {e}")
         raise HTTPException(status_code=500, detail=f"Error al obtener usuarios: {str(e)}")
 
 @app.get("/api/usuarios/{usuario_id}", response_model=User)
-async def obtener_usuario(usuario_id: int):
+async def obtener_usuario(
+    usuario_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    client: Optional[Client] = Depends(supabase_client),
+    pool=Depends(get_db_pool)
+):
     """Obtener un usuario específico por ID"""
-    if not supabase:
+    if not pool and not client:
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     
+    clave = ("usuario", usuario_id)
+    
     try:
-        response = supabase.table("usuarios").select("*").eq("id", usuario_id).execute()
-        
-        if hasattr(response, 'error') and response.error:
-            raise HTTPException(status_code=500, detail=response.error.message)
-            
-        if not response.data:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        cached = _CACHE.get(clave)
+        if cached is None:
+            if pool:
+                usuario = await _pg_obtener_usuario(pool, usuario_id)
+            else:
+                result = await _db(client.table("usuarios").select(USUARIO_COLUMNAS).eq("id", usuario_id).limit(1).execute)
+                usuario = result.data[0] if result.data else None
+                
+            if not usuario:
+                raise HTTPException(status_code=404, detail="Usuario no encontrado")
             
-        return response.data[0]
+            cached = _CACHE[clave] = (usuario, _calcular_etag(usuario))
+        
+        usuario, etag = cached
+        if if_none_match == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        
+        response.headers["ETag"] = etag
+        return usuario
         
     except HTTPException:
         raise
@@ -264,12 +574,16 @@ async def obtener_usuario(usuario_id: int):
 @app.post("/api/usuarios", response_model=User, status_code=status.HTTP_201_CREATED)
 async def crear_usuario(
     nombre: str = Form(..., min_length=1, max_length=100),
-    email: str = Form(..., regex=r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'),
+    email: str = Form(...),
     telefono: str = Form(..., min_length=1, max_length=20),
-    foto: Optional[UploadFile] = File(None)
+    foto: Optional[UploadFile] = File(None),
+    client: Optional[Client] = Depends(supabase_client),
+    pool=Depends(get_db_pool)
 ):
     """Crear un nuevo usuario"""
-    if not supabase:
+    email = _normalizar_email(email)
+    
+    if not pool and not client:
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     
     try:
@@ -277,30 +591,45 @@ async def crear_usuario(
         
         # Subir imagen si se proporciona
         if foto:
-            foto_url = await subir_imagen_supabase(foto)
+            foto_url = await subir_imagen_supabase(client, foto)
         
         # Preparar datos
         user_data = {
-            "nombre": nombre.strip(),
-            "email": email.lower().strip(),
-            "telefono": telefono.strip(),
+            "nombre": _normalizar(nombre),
+            "email": email,
+            "telefono": _normalizar(telefono),
             "foto_url": foto_url
         }
         
-        # Insertar en Supabase
-        response = supabase.table("usuarios").insert(user_data).execute()
-        
-        if hasattr(response, 'error') and response.error:
-            if "duplicate key" in response.error.message.lower():
-                raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado")
-            logger.error(f"❌ Error creando usuario: {response.error.message}")
-            raise HTTPException(status_code=500, detail=response.error.message)
-            
-        if not response.data:
-            raise HTTPException(status_code=400, detail="No se pudo crear el usuario")
+        try:
+            if pool:
+                # Insertar en Postgres
+                try:
+                    usuario = await _pg_crear_usuario(pool, user_data)
+                except asyncpg.UniqueViolationError:
+                    raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado")
+            else:
+                # Insertar en Supabase
+                try:
+                    response = await _db(client.table("usuarios").insert(user_data).execute)
+                except APIError as e:
+                    if "duplicate key" in str(e).lower():
+                        raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado")
+                    raise
+                    
+                if not response.data:
+                    raise HTTPException(status_code=400, detail="No se pudo crear el usuario")
+                
+                usuario = response.data[0]
+        except Exception:
+            # Si la inserción falla, la imagen recién subida quedaría huérfana
+            if foto_url:
+                await _db(eliminar_imagen_supabase, client, foto_url)
+            raise
         
+        _CACHE.clear()
         logger.info(f"✅ Usuario creado: {email}")
-        return response.data[0]
+        return usuario
         
     except HTTPException:
         raise
@@ -311,55 +640,91 @@ async def crear_usuario(
 @app.put("/api/usuarios/{usuario_id}", response_model=User)
 async def editar_usuario(
     usuario_id: int,
+    background_tasks: BackgroundTasks,
     nombre: str = Form(..., min_length=1, max_length=100),
-    email: str = Form(..., regex=r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'),
+    email: str = Form(...),
     telefono: str = Form(..., min_length=1, max_length=20),
-    foto: Optional[UploadFile] = File(None)
+    foto: Optional[UploadFile] = File(None),
+    client: Optional[Client] = Depends(supabase_client),
+    pool=Depends(get_db_pool)
 ):
     """Editar un usuario existente"""
-    if not supabase:
+    email = _normalizar_email(email)
+    
+    if not pool and not client:
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     
     try:
-        # Verificar que existe
-        existing_response = supabase.table("usuarios").select("*").eq("id", usuario_id).execute()
-        
-        if hasattr(existing_response, 'error') and existing_response.error:
-            raise HTTPException(status_code=500, detail=existing_response.error.message)
-            
-        if not existing_response.data:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
-        
-        existing_user = existing_response.data[0]
         update_data = {
-            "nombre": nombre.strip(),
-            "email": email.lower().strip(),
-            "telefono": telefono.strip()
+            "nombre": _normalizar(nombre),
+            "email": email,
+            "telefono": _normalizar(telefono)
         }
+        foto_anterior = None
         
-        # Procesar nueva imagen
-        if foto:
-            # Eliminar imagen anterior si existe
-            if existing_user.get("foto_url"):
-                await eliminar_imagen_supabase(existing_user["foto_url"])
+        if foto and not pool:
+            # PostgREST no devuelve la fila previa al actualizar: la foto actual se
+            # consulta mientras se sube la nueva, ya que son independientes
+            # return_exceptions=True espera a ambas: si la consulta falla, la subida
+            # no queda en curso y la imagen nueva se puede eliminar
+            existing_response, foto_url = await asyncio.gather(
+                _db(client.table("usuarios").select("foto_url").eq("id", usuario_id).limit(1).execute),
+                subir_imagen_supabase(client, foto),
+                return_exceptions=True
+            )
             
-            # Subir nueva imagen
-            foto_url = await subir_imagen_supabase(foto)
+            if isinstance(foto_url, BaseException):
+                raise foto_url
             update_data["foto_url"] = foto_url
+            
+            if isinstance(existing_response, BaseException) or not existing_response.data:
+                await _db(eliminar_imagen_supabase, client, foto_url)
+                if isinstance(existing_response, BaseException):
+                    raise existing_response
+                raise HTTPException(status_code=404, detail="Usuario no encontrado")
+            
+            foto_anterior = existing_response.data[0].get("foto_url")
+        elif foto:
+            # Subir nueva imagen
+            update_data["foto_url"] = await subir_imagen_supabase(client, foto)
         
-        # Actualizar en Supabase
-        response = supabase.table("usuarios").update(update_data).eq("id", usuario_id).execute()
-        
-        if hasattr(response, 'error') and response.error:
-            if "duplicate key" in response.error.message.lower():
-                raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado en otro usuario")
-            raise HTTPException(status_code=500, detail=response.error.message)
+        try:
+            if pool:
+                # Actualizar en Postgres (devuelve también la foto anterior)
+                try:
+                    usuario = await _pg_actualizar_usuario(pool, usuario_id, update_data)
+                except asyncpg.UniqueViolationError:
+                    raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado en otro usuario")
+                
+                if usuario:
+                    foto_anterior = usuario.pop("foto_url_anterior")
+            else:
+                # Actualizar en Supabase
+                try:
+                    response = await _db(client.table("usuarios").update(update_data).eq("id", usuario_id).execute)
+                except APIError as e:
+                    if "duplicate key" in str(e).lower():
+                        raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado en otro usuario")
+                    raise
+                
+                usuario = response.data[0] if response.data else None
             
-        if not response.data:
-            raise HTTPException(status_code=400, detail="No se pudo actualizar el usuario")
+            if not usuario:
+                raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        except Exception:
+            # Si la actualización falla, la imagen recién subida quedaría huérfana
+            # (las tareas en segundo plano no se ejecutan cuando la respuesta es un error)
+            if foto:
+                await _db(eliminar_imagen_supabase, client, update_data["foto_url"])
+            raise
+        
+        # Eliminar imagen anterior si se reemplazó
+        if foto and foto_anterior:
+            background_tasks.add_task(eliminar_imagen_supabase, client, foto_anterior)
         
+        _CACHE.clear()
         logger.info(f"✅ Usuario actualizado: {usuario_id}")
-        return response.data[0]
+        return usuario
         
     except HTTPException:
         raise
@@ -368,33 +733,32 @@ async def editar_usuario(
         raise HTTPException(status_code=500, detail=f"Error al actualizar usuario: {str(e)}")
 
 @app.delete("/api/usuarios/{usuario_id}")
-async def eliminar_usuario(usuario_id: int):
+async def eliminar_usuario(
+    usuario_id: int,
+    background_tasks: BackgroundTasks,
+    client: Optional[Client] = Depends(supabase_client),
+    pool=Depends(get_db_pool)
+):
     """Eliminar un usuario (opcional)"""
-    if not supabase:
+    if not pool and not client:
         raise HTTPException(status_code=503, detail="Servicio de base de datos no disponible")
     
     try:
-        # Verificar que existe
-        existing_response = supabase.table("usuarios").select("*").eq("id", usuario_id).execute()
-        
-        if hasattr(existing_response, 'error') and existing_response.error:
-            raise HTTPException(status_code=500, detail=existing_response.error.message)
+        # Eliminar usuario (devuelve la fila eliminada)
+        if pool:
+            existing_user = await _pg_eliminar_usuario(pool, usuario_id)
+        else:
+            response = await _db(client.table("usuarios").delete().eq("id", usuario_id).execute)
+            existing_user = response.data[0] if response.data else None
             
-        if not existing_response.data:
+        if not existing_user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        existing_user = existing_response.data[0]
-        
         # Eliminar imagen del storage si existe
         if existing_user.get("foto_url"):
-            await eliminar_imagen_supabase(existing_user["foto_url"])
-        
-        # Eliminar usuario
-        response = supabase.table("usuarios").delete().eq("id", usuario_id).execute()
-        
-        if hasattr(response, 'error') and response.error:
-            raise HTTPException(status_code=500, detail=response.error.message)
+            background_tasks.add_task(eliminar_imagen_supabase, client, existing_user["foto_url"])
         
+        _CACHE.clear()
         logger.info(f"✅ Usuario eliminado: {usuario_id}")
         return {"message": "Usuario eliminado correctamente", "success": True}
         
@@ -407,9 +771,15 @@ async def eliminar_usuario(usuario_id: int):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
+    development = os.getenv("ENVIRONMENT") == "development"
+    # reload no es compatible con varios workers: en desarrollo se usa un único proceso.
+    # loop/http en "auto" eligen uvloop y httptools cuando están instalados.
     uvicorn.run(
-        app,
+        "main:app",
         host="0.0.0.0",
         port=port,
-        reload=os.getenv("ENVIRONMENT") == "development"
+        loop="auto",
+        http="auto",
+        workers=1 if development else int(os.getenv("WEB_CONCURRENCY", "4")),
+        reload=development
     )
\ No newline at end of file
@@ -0,0 +1,30 @@
+from typing import Optional
+from pydantic import BaseModel, ConfigDict
+
+# Modelos Pydantic
+class UserBase(BaseModel):
+    nombre: str
+    email: str
+    telefono: str
+
+class User(UserBase):
+    model_config = ConfigDict(from_attributes=True, extra="ignore")
+
+    id: int
+    foto_url: Optional[str] = None
+    creado_en: Optional[str] = None
+
+class UserPage(BaseModel):
+    data: list[User]
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class SuccessResponse(BaseModel):
+    message: str
+    success: bool = True
+
+class HealthResponse(BaseModel):
+    status: str
+    database: str
+    timestamp: str
+    environment: str
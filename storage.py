@@ -0,0 +1,167 @@
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+import os
+import base64
+import logging
+from secrets import token_hex
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    from supabase import Client
+    import httpx
+except ImportError:
+    Client = Any  # Marcador para las anotaciones de tipo
+
+BUCKET_NAME = "StudentMgmt_FastApi"
+_BUCKET_SEP = f"/{BUCKET_NAME}/"
+
+# Tamaño máximo de las imágenes subidas
+MAX_FOTO_BYTES = 20 * 1024 * 1024
+
+# Mismo valor por defecto que las subidas de storage3
+CACHE_CONTROL = "3600"
+
+# Subidas reanudables (protocolo TUS de Supabase Storage)
+TUS_UMBRAL = 5 * 1024 * 1024
+TUS_CHUNK_SIZE = 6 * 1024 * 1024  # Supabase exige fragmentos de exactamente 6 MB
+TUS_REINTENTOS = 3
+
+# Firmas (magic bytes) de las imágenes aceptadas
+FIRMAS_IMAGEN = (b"\x89PNG", b"\xff\xd8\xff")
+
+def _es_imagen(cabecera: bytes) -> bool:
+    """Comprueba si los primeros 12 bytes corresponden a PNG, JPEG o WEBP"""
+    return cabecera.startswith(FIRMAS_IMAGEN) or (
+        cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP"
+    )
+
+def _tus_metadata(**valores: str) -> str:
+    return ",".join(
+        f"{clave} {base64.b64encode(valor.encode()).decode()}"
+        for clave, valor in valores.items()
+    )
+
+def _subir_tus(session, file, size: int, path: str, content_type: str):
+    """Sube un archivo grande en fragmentos con el endpoint reanudable de Storage.
+
+    Cada fragmento se reintenta de forma independiente; tras un fallo se
+    consulta el offset confirmado por el servidor y se continúa desde ahí.
+    """
+    response = session.post(
+        "/upload/resumable",
+        headers={
+            "Tus-Resumable": "1.0.0",
+            "Upload-Length": str(size),
+            "Upload-Metadata": _tus_metadata(
+                bucketName=BUCKET_NAME,
+                objectName=path,
+                contentType=content_type,
+                cacheControl=CACHE_CONTROL
+            )
+        }
+    )
+    response.raise_for_status()
+    upload_url = response.headers["Location"]
+
+    offset = 0
+    while offset < size:
+        for intento in range(1, TUS_REINTENTOS + 1):
+            try:
+                file.seek(offset)
+                response = session.patch(
+                    upload_url,
+                    content=file.read(TUS_CHUNK_SIZE),
+                    headers={
+                        "Tus-Resumable": "1.0.0",
+                        "Upload-Offset": str(offset),
+                        "Content-Type": "application/offset+octet-stream"
+                    }
+                )
+                response.raise_for_status()
+                offset = int(response.headers["Upload-Offset"])
+                break
+            except httpx.HTTPError as e:
+                if intento == TUS_REINTENTOS:
+                    raise
+                logger.warning(f"⚠️  Reintentando fragmento en offset {offset}: {e}")
+                head = session.head(upload_url, headers={"Tus-Resumable": "1.0.0"})
+                head.raise_for_status()
+                offset = int(head.headers["Upload-Offset"])
+
+async def subir_imagen_supabase(client: Optional[Client], file: UploadFile) -> str:
+    """Sube una imagen al bucket de Supabase Storage"""
+    if not client:
+        raise HTTPException(status_code=500, detail="Servicio de almacenamiento no disponible")
+    
+    try:
+        if not file.content_type.startswith('image/'):
+            raise ValueError("El archivo debe ser una imagen")
+        
+        # Verificar el tipo real por sus primeros bytes
+        await file.seek(0)
+        if not _es_imagen(await file.read(12)):
+            raise HTTPException(status_code=415, detail="El archivo no es una imagen PNG, JPEG o WEBP")
+        
+        # Generar nombre único
+        _, punto, file_extension = file.filename.rpartition('.')
+        if not punto:
+            file_extension = 'jpg'
+        filename = f"usuarios/{token_hex(4)}.{file_extension}"
+        
+        # Calcular el tamaño sin leer el contenido
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+        await file.seek(0)
+        
+        if size > MAX_FOTO_BYTES:
+            raise HTTPException(status_code=413, detail="La imagen supera el tamaño máximo permitido")
+        
+        session = client.storage._client
+        if size > TUS_UMBRAL:
+            # Archivos grandes: subida reanudable por fragmentos
+            await run_in_threadpool(_subir_tus, session, file.file, size, filename, file.content_type)
+        else:
+            # Subir a Supabase Storage en streaming, sin cargar el archivo en memoria
+            response = await run_in_threadpool(
+                session.post,
+                f"/object/{BUCKET_NAME}/{filename}",
+                content=file.file,
+                headers={
+                    "content-type": file.content_type,
+                    "cache-control": f"max-age={CACHE_CONTROL}",
+                    "x-upsert": "false"
+                }
+            )
+            response.raise_for_status()
+        
+        # Obtener URL pública
+        public_url = client.storage.from_(BUCKET_NAME).get_public_url(filename)
+        logger.info(f"✅ Imagen subida: {filename}")
+        
+        return public_url
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error subiendo imagen: {e}")
+        raise HTTPException(status_code=400, detail=f"Error al subir imagen: {str(e)}")
+
+def eliminar_imagen_supabase(client: Optional[Client], image_url: str):
+    """Elimina una imagen del Supabase Storage.
+
+    Es síncrona para poder encolarla con BackgroundTasks: Starlette la ejecuta
+    en el threadpool después de enviar la respuesta.
+    """
+    if not client or not image_url:
+        return
+        
+    try:
+        _, sep, filename = image_url.rpartition(_BUCKET_SEP)
+        if not sep:
+            return
+        client.storage.from_(BUCKET_NAME).remove([filename])
+        logger.info(f"✅ Imagen eliminada: {filename}")
+    except Exception as e:
+        logger.warning(f"⚠️  Error eliminando imagen: {e}")
@@ -0,0 +1,197 @@
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from postgrest import SyncPostgrestClient
+
+import main
+
+REST_URL = "http://supabase.test/rest/v1"
+STORAGE_URL = "http://supabase.test/storage/v1"
+
+USUARIOS = [
+    {
+        "id": 2,
+        "nombre": "Ana",
+        "email": "ana@example.com",
+        "telefono": "70000002",
+        "foto_url": None,
+        "creado_en": "2024-05-02T10:00:00+00:00"
+    },
+    {
+        "id": 1,
+        "nombre": "Luis",
+        "email": "luis@example.com",
+        "telefono": "70000001",
+        "foto_url": None,
+        "creado_en": "2024-05-01T10:00:00+00:00"
+    },
+]
+
+FORMULARIO = {"nombre": "Eva", "email": "eva@example.com", "telefono": "70000003"}
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 16
+FOTO_ANTERIOR = f"{STORAGE_URL}/object/public/{main.BUCKET_NAME}/usuarios/anterior.png"
+
+
+@pytest.fixture
+def peticiones():
+    return []
+
+
+@pytest.fixture
+def eliminadas(monkeypatch):
+    """URLs de las imágenes que la app manda eliminar de Storage"""
+    urls = []
+    monkeypatch.setattr(main, "eliminar_imagen_supabase", lambda client, url: urls.append(url))
+    return urls
+
+
+@pytest.fixture
+def montar_api(peticiones):
+    """Monta la app con PostgREST y Storage simulados mediante httpx.MockTransport"""
+    def montar(handler):
+        def registrar(request: httpx.Request) -> httpx.Response:
+            peticiones.append(request)
+            return handler(request)
+
+        postgrest = SyncPostgrestClient(REST_URL)
+        postgrest.session = httpx.Client(base_url=REST_URL, transport=httpx.MockTransport(registrar))
+        storage = SimpleNamespace(
+            _client=httpx.Client(base_url=STORAGE_URL, transport=httpx.MockTransport(registrar)),
+            from_=lambda bucket: SimpleNamespace(
+                get_public_url=lambda path: f"{STORAGE_URL}/object/public/{bucket}/{path}"
+            )
+        )
+        client = SimpleNamespace(table=postgrest.from_, storage=storage)
+
+        main.app.dependency_overrides[main.supabase_client] = lambda: client
+        main.app.dependency_overrides[main.get_db_pool] = lambda: None
+        return TestClient(main.app)
+
+    main._CACHE.clear()
+    yield montar
+    main.app.dependency_overrides.clear()
+    main._CACHE.clear()
+
+
+@pytest.fixture
+def api(montar_api):
+    """Cliente de pruebas cuyo PostgREST pagina USUARIOS e inserta usuarios nuevos"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            return httpx.Response(
+                201,
+                json=[{**json.loads(request.content), "id": 3, "creado_en": "2024-05-03T10:00:00+00:00"}]
+            )
+        limit = int(request.url.params["limit"])
+        if "or" in request.url.params:
+            return httpx.Response(200, json=USUARIOS[1:1 + limit])
+        return httpx.Response(
+            200,
+            json=USUARIOS[:limit],
+            headers={"content-range": f"0-{limit - 1}/{len(USUARIOS)}"}
+        )
+
+    return montar_api(handler)
+
+
+def _handler_editar(consulta: httpx.Response):
+    """PostgREST responde `consulta` al buscar la foto actual y aplica el PATCH sobre el usuario 1"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.startswith("/storage/"):
+            return httpx.Response(200, json={"Key": "ok"})
+        if request.method == "GET":
+            return consulta
+        return httpx.Response(200, json=[{**USUARIOS[1], **json.loads(request.content)}])
+    return handler
+
+
+def test_listar_usuarios_segunda_pagina(api, peticiones):
+    primera = api.get("/api/usuarios", params={"limit": 1})
+    assert primera.status_code == 200
+    body = primera.json()
+    assert [u["id"] for u in body["data"]] == [2]
+    assert body["total"] == 2
+    assert body["next_cursor"]
+
+    segunda = api.get("/api/usuarios", params={"limit": 1, "cursor": body["next_cursor"]})
+    assert segunda.status_code == 200
+    body = segunda.json()
+    assert [u["id"] for u in body["data"]] == [1]
+    assert body["total"] is None
+
+    creado_en = USUARIOS[0]["creado_en"]
+    assert peticiones[-1].url.params.get_list("order") == ["creado_en.desc,id.desc"]
+    assert peticiones[-1].url.params["or"] == (
+        f'(creado_en.lt."{creado_en}",and(creado_en.eq."{creado_en}",id.lt.2))'
+    )
+
+
+def test_listar_usuarios_cursor_invalido(api):
+    response = api.get("/api/usuarios", params={"cursor": "no-es-un-cursor"})
+    assert response.status_code == 400
+
+
+def test_listar_usuarios_if_none_match_devuelve_304(api, peticiones):
+    etag = api.get("/api/usuarios").headers["etag"]
+    response = api.get("/api/usuarios", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert len(peticiones) == 1  # la segunda lectura sale de la caché
+
+
+def test_crear_usuario_vacia_cache(api, peticiones):
+    api.get("/api/usuarios")
+    assert main._CACHE
+    response = api.post("/api/usuarios", data=FORMULARIO)
+    assert response.status_code == 201
+    assert not main._CACHE
+    api.get("/api/usuarios")
+    assert [p.method for p in peticiones] == ["GET", "POST", "GET"]
+
+
+def test_crear_usuario_cuerpo_demasiado_grande(api, peticiones, monkeypatch):
+    monkeypatch.setattr(main, "MAX_CUERPO_BYTES", 1024)
+    response = api.post(
+        "/api/usuarios",
+        data=FORMULARIO,
+        files={"foto": ("foto.png", PNG + b"\0" * 2048, "image/png")}
+    )
+    assert response.status_code == 413
+    assert peticiones == []
+
+
+def test_crear_usuario_foto_no_es_imagen(api, peticiones):
+    response = api.post(
+        "/api/usuarios",
+        data=FORMULARIO,
+        files={"foto": ("foto.png", b"GIF89a" + b"\0" * 16, "image/png")}
+    )
+    assert response.status_code == 415
+    assert peticiones == []
+
+
+def test_editar_usuario_falla_consulta_elimina_foto_nueva(montar_api, eliminadas):
+    api = montar_api(_handler_editar(httpx.Response(500, json={"message": "fallo", "code": "XX000"})))
+    response = api.put("/api/usuarios/1", data=FORMULARIO, files={"foto": ("foto.png", PNG, "image/png")})
+    assert response.status_code == 500
+    assert len(eliminadas) == 1
+    assert eliminadas[0].startswith(f"{STORAGE_URL}/object/public/{main.BUCKET_NAME}/usuarios/")
+
+
+def test_editar_usuario_inexistente_elimina_foto_nueva(montar_api, eliminadas):
+    api = montar_api(_handler_editar(httpx.Response(200, json=[])))
+    response = api.put("/api/usuarios/1", data=FORMULARIO, files={"foto": ("foto.png", PNG, "image/png")})
+    assert response.status_code == 404
+    assert len(eliminadas) == 1
+    assert eliminadas[0].startswith(f"{STORAGE_URL}/object/public/{main.BUCKET_NAME}/usuarios/")
+
+
+def test_editar_usuario_elimina_foto_anterior_en_segundo_plano(montar_api, eliminadas):
+    api = montar_api(_handler_editar(httpx.Response(200, json=[{"foto_url": FOTO_ANTERIOR}])))
+    response = api.put("/api/usuarios/1", data=FORMULARIO, files={"foto": ("foto.png", PNG, "image/png")})
+    assert response.status_code == 200
+    assert response.json()["foto_url"] != FOTO_ANTERIOR
+    assert eliminadas == [FOTO_ANTERIOR]
@@ -1,9 +1,10 @@
 import os
 from dotenv import load_dotenv
-from supabase import create_client
 
 load_dotenv()
 
+from main import get_supabase
+
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
 
@@ -11,7 +12,9 @@ print(f"URL: {supabase_url}")
 print(f"KEY: {supabase_key[:20]}...")  # Mostrar solo primeros 20 caracteres
 
 try:
-    supabase = create_client(supabase_url, supabase_key)
+    supabase = get_supabase()
+    if supabase is None:
+        raise RuntimeError("No se pudo crear el cliente de Supabase")
     
     # Test de conexión
     response = supabase.table('usuarios').select('*').limit(1).execute()